@@ -4,16 +4,125 @@ import argparse
 import logging
 import struct
 import os
+import sys
 from pathlib import Path
 import glob
 import mmap
 import io
-import subprocess
 import uuid
 import json
+import functools
+import re
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+import numpy as np
 import PIL.Image as PILImage
-from mrcrowbar import utils
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda fn: fn
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+U32 = struct.Struct("<L")
+HD_HEADER = struct.Struct("<4sLLL4sLLL")
+CD_HEADER = struct.Struct("<LLLL")
+CHR_HEADER = struct.Struct("<4sLL256sL")
+ACTN_HEADER = struct.Struct("<LL256s64s")
+PART_HEADER = struct.Struct("<4sLL64s64sL")
+KWAV_HEADER = struct.Struct("<4sL")
+SNCM_HEADER = struct.Struct("<4sLL")
+ANG_HEADER = struct.Struct("<4sLLLLL")
+ANG_META_FRAME = struct.Struct("<HHH")
+ANG_FRAME_HEADER = struct.Struct("<HHL")
+WAV_HEADER = struct.Struct("<4sL4s4sLHHLLHH4sL")
+
+NONZERO = re.compile(rb'[^\x00]')
+BYTE_NAMES = [str(i) for i in range(256)]
+ZERO2 = bytes(2)
+ZERO256 = bytes(0x100)
+
+# Padding comparisons only run with --verify, and raise ValueError so they
+# still run under python -O, which drops the remaining structural asserts.
+VERIFY = False
+
+META_FRAME = np.dtype([("x", "<u2"), ("y", "<u2"), ("n", "<u2")])
+CHR_COMPONENTS = np.dtype([("string", "S316"), ("id", "<u4")])
+
+ANG_META_FRAMES = np.dtype([
+    ("marker", "<u2"), ("x", "<u2"), ("y", "<u2"), ("n", "<u2"), ("zero", "<u2"), ("footer", "<u2")
+])
+
+class Cursor:
+    # Plain offset arithmetic over the mapped file; mmap's own read/seek cost a
+    # method call each and read() copies.
+    __slots__ = ("buffer", "view", "pos")
+
+    def __init__(self, buffer, pos=0):
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.pos = pos
+
+    def size(self):
+        return len(self.view)
+
+    def read(self, length):
+        pos = self.pos
+        data = self.buffer[pos:pos + length]
+        self.pos = pos + len(data)
+        return data
+
+def read_struct(stream, layout):
+    pos = stream.pos
+    stream.pos = pos + layout.size
+    return layout.unpack_from(stream.view, pos)
+
+def read_u32(stream):
+    return read_struct(stream, U32)[0]
+
+def read_view(stream, length):
+    pos = stream.pos
+    view = stream.view[pos:pos + length]
+    stream.pos = pos + len(view)
+    return view
+
+def seek_past(stream, marker):
+    # Equivalent to reading len(marker)-byte words until one matches, but the
+    # search itself runs in C.
+    pos = stream.pos
+    found = stream.buffer.find(marker, pos)
+    while found != -1 and (found - pos) % len(marker):
+        found = stream.buffer.find(marker, found + 1)
+
+    if found == -1:
+        raise ValueError("Marker {} not found after 0x{:012x}".format(marker, pos))
+
+    stream.pos = found + len(marker)
+
+def read_array(stream, dtype, count):
+    pos = stream.pos
+    values = np.frombuffer(stream.buffer, dtype=dtype, count=count, offset=pos)
+    stream.pos = pos + values.nbytes
+    return values
+
+def decode_id(raw):
+    return raw.rstrip(b'\x00').decode("utf-8", "backslashreplace")
+
+def decode_string(raw):
+    return raw.rstrip(b'\x00').decode("utf-8", "replace")
+
+def fourcc(raw):
+    return int.from_bytes(raw, "little")
+
+@functools.lru_cache(maxsize=None)
+def fourcc_name(id):
+    return sys.intern(decode_id(id.to_bytes(4, "little")))
 
 def value_assert(stream, target, type="value", warn=False):
     ax = stream
@@ -22,172 +131,363 @@ def value_assert(stream, target, type="value", warn=False):
     except AttributeError:
         pass
 
+    if ax == target:
+        return
+
     msg = "Expected {} {}{}, received {}{}".format(
         type, target, " (0x{:0>4x})".format(target) if isinstance(target, int) else "",
         ax, " (0x{:0>4x})".format(ax) if isinstance(ax, int) else "",
     )
-    if warn and ax != target:
+    if warn:
         logging.warning(msg)
     else:
         assert ax == target, msg
 
 def encode_filename(filename, fmt):
-    if filename[-4:] != ".{}".format(fmt.lower()):
-        filename += (".{}".format(fmt.lower()))
+    extension = "." + fmt.lower()
+    if not filename.endswith(extension):
+        filename += extension
 
     return filename
 
+def write_all(of, data):
+    # Flatten to bytes so a short write resumes at the right byte even for
+    # multi-dimensional buffers such as frame bitmaps.
+    data = memoryview(data).cast("B")
+    while data:
+        data = data[of.write(data):]
+
+def export_raw(data, filename):
+    # Payloads are views of the mmap, so the kernel copies straight from the
+    # page cache; an unbuffered file keeps Python from staging them as well.
+    with open(filename, 'wb', buffering=0) as of:
+        write_all(of, data)
+
+def export_wav(data, filename):
+    # KWAV samples are already s16le mono PCM, so only the RIFF wrapper is needed.
+    # A trailing odd byte isn't a whole sample, so drop it as ffmpeg did.
+    length = len(data) & ~1
+    data = data[:length]
+    header = WAV_HEADER.pack(
+        b'RIFF', 36 + length, b'WAVE',
+        b'fmt ', 16, 1, 1, 11025, 11025 * 2, 2, 16,
+        b'data', length
+    )
+    with open(filename, 'wb', buffering=0) as of:
+        write_all(of, header)
+        write_all(of, data)
+
+    logging.debug("export_wav: Wrote output on %s", filename)
+
+def export_pgm(bitmap, filename):
+    # Raw palette indices as 8-bit greyscale; no encoder involved at all.
+    height, width = bitmap.shape
+    with open(filename, 'wb', buffering=0) as of:
+        write_all(of, "P5\n{} {}\n255\n".format(width, height).encode("ascii"))
+        write_all(of, np.ascontiguousarray(bitmap))
+
+def export_json(obj, filename):
+    if orjson is not None:
+        with open(filename, 'wb') as of:
+            of.write(orjson.dumps(obj))
+    else:
+        with open(filename, 'w') as of:
+            json.dump(obj, fp=of)
+
+class ExportError(Exception):
+    pass
+
+def run_batch(jobs):
+    # One failed export shouldn't take the rest of its batch down with it; each
+    # failure is logged against its own chunk and the first one is re-raised.
+    failed = None
+    for source, fn, args, kwargs in jobs:
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            logging.exception("Export of %s (chunk at 0x%012x) failed", *source)
+            if failed is None:
+                failed = source, e
+
+    if failed:
+        (name, start), e = failed
+        raise ExportError("Export of {} (chunk at 0x{:012x}) failed".format(name, start)) from e
+
+# Export jobs spend their time in file I/O and PIL's PNG encoder, both of which
+# release the GIL, so threads are enough to overlap them and the mmap-backed
+# payloads never have to be pickled. Decoded images are submitted one per job,
+# so at most max_workers * 2 of them are held at once; raw and WAV writes only
+# reference the mmap and are cheap, so they are handed over in batches.
+class ExportPool:
+    def __init__(self, max_workers=None, batch_size=32):
+        self.max_workers = max_workers or os.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.pending = set()
+        self.batch_size = batch_size
+        self.batch = []
+
+    # source is a (name, start) pair identifying the chunk in error reports.
+    def submit(self, source, fn, *args, **kwargs):
+        self.run([(source, fn, args, kwargs)])
+
+    def submit_batched(self, source, fn, *args, **kwargs):
+        self.batch.append((source, fn, args, kwargs))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+
+        self.run(self.batch)
+        self.batch = []
+
+    def run(self, jobs):
+        if len(self.pending) >= self.max_workers * 2:
+            done, self.pending = wait(self.pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+        self.pending.add(self.executor.submit(run_batch, jobs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        done, self.pending = wait(self.pending)
+        self.executor.shutdown()
+        for future in done:
+            future.result()
+
+@njit(cache=True)
+def scan_chunks(buf, start):
+    # Walks the CDChunk headers from start and returns the offset and payload
+    # length of every chunk, trusting the length field to find the next one.
+    size = buf.shape[0]
+    count = 0
+    pos = start
+    while pos + 16 <= size:
+        length = np.int64(buf[pos + 12]) | (np.int64(buf[pos + 13]) << 8) | \
+            (np.int64(buf[pos + 14]) << 16) | (np.int64(buf[pos + 15]) << 24)
+        pos += 16 + length
+        count += 1
+
+    offsets = np.empty(count, np.int64)
+    lengths = np.empty(count, np.int64)
+    pos = start
+    for i in range(count):
+        length = np.int64(buf[pos + 12]) | (np.int64(buf[pos + 13]) << 8) | \
+            (np.int64(buf[pos + 14]) << 16) | (np.int64(buf[pos + 15]) << 24)
+        offsets[i] = pos
+        lengths[i] = length
+        pos += 16 + length
+
+    return offsets, lengths
+
+@njit(cache=True)
+def decode_rle(src, dst, pos, end):
+    # Decodes one ANGFrame line from src[pos:end] into dst and zero-fills the rest
+    # of it. Returns the number of pixels produced (more than len(dst) on
+    # overflow, -1 if a run is cut off by the end of src) and where decoding
+    # stopped. Compiled code does no bounds checking, so src limits are
+    # enforced here.
+    width = dst.shape[0]
+    size = src.shape[0]
+    end = min(end, size)
+    i = 0
+    while pos < end:
+        op = int(src[pos])
+        pos += 1
+        if op & 0x80: # RLE byte next
+            n = op & 0x7f
+            if i + n > width:
+                return i + n, pos
+            if pos >= size:
+                return -1, pos
+            dst[i:i + n] = src[pos]
+            pos += 1
+        else: # unencoded data
+            n = op
+            if i + n > width:
+                return i + n, pos
+            if pos + n > size:
+                return -1, pos
+            dst[i:i + n] = src[pos:pos + n]
+            pos += n
+        i += n
+
+    dst[i:] = 0
+    return i, pos
+
+@njit(cache=True)
+def decode_rle_frame(src, offsets, bitmap):
+    # Decodes every line of an ANGFrame back to back from offsets[0]. Returns the
+    # index of the first line that fails to decode (or -1), its decode_rle
+    # length and the end position.
+    width = bitmap.shape[1]
+    pos = offsets[0]
+    length = 0
+    for i in range(bitmap.shape[0]):
+        length, pos = decode_rle(src, bitmap[i], pos, offsets[i + 1])
+        if length < 0 or length > width:
+            return i, length, pos
+
+    return -1, length, pos
+
+def read_meta_frames(stream, count):
+    # Fast path for the usual layout of back-to-back 02 7f ... 01 7f frame
+    # headers. Returns None if the block doesn't match, so the caller can fall
+    # back to scanning for each header.
+    pos = stream.pos
+    size = count * ANG_META_FRAMES.itemsize
+    if count == 0 or pos + size > stream.size():
+        return None
+
+    records = np.frombuffer(stream.buffer, dtype=ANG_META_FRAMES, count=count, offset=pos)
+    if not ((records["marker"] == 0x7f02).all() and (records["zero"] == 0).all() and (records["footer"] == 0x7f01).all()):
+        return None
+
+    stream.pos = pos + size
+    meta_frames = np.empty(count, dtype=META_FRAME)
+    for field in META_FRAME.names:
+        meta_frames[field] = records[field]
+    return meta_frames
+
 class Object:
-    def __format__(self, spec):
-        return self.__repr__()
+    pass
 
 class HDChunk(Object):
     def __init__(self, stream):
-        self.id = stream.read(0x04).replace(b'\x00', b'').decode("utf-8")
-        unk1 = struct.unpack("<L", stream.read(4))[0]
-        unk2 = struct.unpack("<L", stream.read(4))[0]
-        unk3 = struct.unpack("<L", stream.read(4))[0]
+        id, unk1, unk2, unk3, comp, unk4, unk5, self.length = read_struct(stream, HD_HEADER)
+        self.id = decode_id(id)
         # assert unk1 == unk2
 
-        assert stream.read(0x04) == b'COMP'
-        unk4 = struct.unpack("<L", stream.read(4))[0]
-        unk5 = struct.unpack("<L", stream.read(4))[0]
+        assert comp == b'COMP'
         # assert unk3 == unk4
 
-        self.length = struct.unpack("<L", stream.read(4))[0]
-        data = stream.read(self.length)
+        data = read_view(stream, self.length)
 
 class CDChunk(Object):
-    def __init__(self, stream):
+    def __init__(self, stream, skip=False):
         self.chunk = None
-        self.id = stream.read(0x04).replace(b'\x00', b'').decode("utf-8")
-
-        assert stream.read(4) == b'\x00' * 4
-        unk2 = struct.unpack("<L", stream.read(4))[0] # 10 00
-
-        self.length = struct.unpack("<L", stream.read(4))[0]
-
-        if self.id == 'KWAV':
-            self.chunk = KWAV(stream)
-        elif self.id == 'ANG':
-            self.chunk = ANG(stream)
-        elif self.id == 'FNT0':
-            self.chunk = FNT0(stream, self.length)
-        elif self.id == 'CHR':
-            self.chunk = CHR(stream, self.length)
-        elif self.id == 'P800':
-            self.chunk = ANGFrame(stream)
-        elif self.id == 'SNCM':
-            self.chunk = SNCM(stream)
-        elif self.id == 'XXXX':
-            if self.length == 0x0300: # Palette
-                self.chunk = stream.read(self.length)
-            else:
-                self.chunk = Container(stream)
+        id, zero, unk2, self.length = read_struct(stream, CD_HEADER) # unk2: 10 00
+        self.id = fourcc_name(id)
+        assert zero == 0
+
+        if skip:
+            stream.pos += self.length
+            return
+
+        handler = CHUNK_HANDLERS.get(id)
+        if handler:
+            self.chunk = handler(stream, self.length)
         else:
-            logging.warning("CDChunk: Unknown chunk type: {}".format(self.id))
-            self.chunk = stream.read(self.length)
+            logging.warning("CDChunk: Unknown chunk type: %s", self.id)
+            self.chunk = read_view(stream, self.length)
 
     def export(self, directory, filename, **kwargs):
         if callable(getattr(self.chunk, "export", None)):
-            self.chunk.export(directory, filename)
+            self.chunk.export(directory, filename, **kwargs)
         else:
-            with open(os.path.join(directory, filename), 'wb') as of:
-                of.write(self.chunk)
+            export_raw(self.chunk, os.path.join(directory, filename))
 
 class Container(Object):
     def __init__(self, stream):
-        code = struct.unpack("<L", stream.read(4))[0] # 00 00
+        code = read_u32(stream) # 00 00
         if code == 0x0c:
-            sncm = struct.unpack("<L", stream.read(4))[0] # 00 00
+            sncm = read_u32(stream) # 00 00
         else:
             sncm = None
 
-        length = struct.unpack("<L", stream.read(4))[0] # 00 00
+        length = read_u32(stream) # 00 00
 
-        id =  stream.read(4).replace(b'\x00', b'').decode("utf-8")
-        if id == "KWAV":
+        id = stream.read(4)
+        if id == b'KWAV':
             logging.debug("Container: Processing internal WAV...")
             self.chunk = KWAV(stream, check=False)
         else:
-            raise TypeError("Unknown type in container: {}".format(id))
+            raise TypeError("Unknown type in container: {}".format(decode_id(id)))
 
         self.sncm = None
         if sncm:
-            logging.warning("Container: Found internal SNCM (0x{:012x} bytes)".format(length - sncm))
-            self.sncm = stream.read(length - sncm)
+            logging.warning("Container: Found internal SNCM (0x%012x bytes)", length - sncm)
+            self.sncm = read_view(stream, length - sncm)
 
     def export(self, directory, filename, **kwargs):
-        self.chunk.export(directory, filename)
+        self.chunk.export(directory, filename, **kwargs)
         if self.sncm:
-            with open(os.path.join(directory, filename), 'wb') as of:
-                of.write(self.sncm)
+            export_raw(self.sncm, os.path.join(directory, filename))
+
+class Palette(Object):
+    def __init__(self, stream, size):
+        self.data = read_view(stream, size)
+
+    def export(self, directory, filename, **kwargs):
+        export_raw(self.data, os.path.join(directory, filename))
 
 class FNT0(Object):
     def __init__(self, stream, size, check=True):
-        self.data = stream.read(size)
+        self.data = read_view(stream, size)
 
     def export(self, directory, filename, **kwargs):
-        with open(os.path.join(directory, filename), 'wb') as of:
-            of.write(self.data)
+        export_raw(self.data, os.path.join(directory, filename))
 
 class CHR(Object):
     def __init__(self, stream, check=True):
-        assert stream.read(4) == b'CHR\x00'
-        assert stream.read(4) == b'\x00' * 4
+        id, zero, length, padding, component_count = read_struct(stream, CHR_HEADER)
+        assert id == b'CHR\x00'
+        assert zero == 0
+        if VERIFY and padding != ZERO256:
+            raise ValueError("CHR: Nonzero header padding")
+        logging.debug("CHR: Expecting %d components", component_count)
 
-        length = struct.unpack("<L", stream.read(4))[0]
-        assert stream.read(0x100) == b'\x00' * 0x100
-
-        component_count =  struct.unpack("<L", stream.read(4))[0]
-        logging.debug("CHR: Expecting {} components".format(component_count))
-
-        self.names = []
-        for i in range(component_count):
-            name = {
-                "string": stream.read(0x13c).replace(b'\x00', b'').decode("utf-8"),
-                "id": struct.unpack("<L", stream.read(4))[0]
-            }
-            self.names.append(name)
-            logging.debug("CHR: Registered component: {}".format(name))
+        self.components = read_array(stream, CHR_COMPONENTS, component_count)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            for name in self.names:
+                logging.debug("CHR: Registered component: %s", name)
 
-        actn_count = struct.unpack("<L", stream.read(4))[0]
-        logging.debug("CHR: Expecting {} ACTN chunks".format(actn_count))
+        actn_count = read_u32(stream)
+        logging.debug("CHR: Expecting %d ACTN chunks", actn_count)
 
         self.actns = []
         for i in range(actn_count):
-            logging.debug("~~~~ ({}) ACTN ~~~~".format(i))
+            logging.debug("~~~~ (%d) ACTN ~~~~", i)
             self.actns.append(ACTN(stream, component_count))
             logging.debug("~" * 20)
+
+    @property
+    def names(self):
+        return [
+            {"string": decode_string(string), "id": id}
+            for string, id in zip(self.components["string"].tolist(), self.components["id"].tolist())
+        ]
         
     def export(self, directory, filename, **kwargs):
         if filename:
             directory = os.path.join(directory, filename)
         
-        Path(directory).mkdir(parents=True, exist_ok=True)
+        os.makedirs(directory, exist_ok=True)
         for i, actn in enumerate(self.actns):
-            actn.export(directory, str(i))
+            actn.export(directory, str(i), **kwargs)
 
 class ACTN(Object):
     def __init__(self, stream, component_count, check=True):
         if check:
-            assert stream.read(4) == b'ACTN'
+            value_assert(stream, b'ACTN')
 
-        assert stream.read(4) == b'\x00' * 4
-        length = struct.unpack("<L", stream.read(4))[0]
-        assert stream.read(0x100) == b'\x00' * 0x100
+        zero, length, padding, name = read_struct(stream, ACTN_HEADER)
+        assert zero == 0
+        if VERIFY and padding != ZERO256:
+            raise ValueError("ACTN: Nonzero header padding")
 
-        self.name = stream.read(0x40).replace(b'\x00', b'').decode("utf-8")
+        self.name = decode_string(name)
         self.parts = []
         for i in range(component_count):
-            assert stream.read(4) == b'PART'
-            assert stream.read(4) == b'\x00' * 4
-
-            part_length = struct.unpack("<L", stream.read(4))[0]
-            name = stream.read(0x40).replace(b'\x00', b'').decode("utf-8")
-            name2 = stream.read(0x40).replace(b'\x00', b'').decode("utf-8")
+            id, zero, part_length, name, name2, unk1 = read_struct(stream, PART_HEADER)
+            assert id == b'PART'
+            assert zero == 0
 
-            unk1 = struct.unpack("<L", stream.read(4))[0]
             if unk1 == 0:
                 self.parts.append(None)
                 logging.debug("CHR: No part")
@@ -199,247 +499,272 @@ class ACTN(Object):
         if filename:
             directory = os.path.join(directory, filename)
                    
-        Path(directory).mkdir(parents=True, exist_ok=True)
+        os.makedirs(directory, exist_ok=True)
         for i, part in enumerate(self.parts):
-            if part: part.export(directory, str(i))
+            if part: part.export(directory, str(i), **kwargs)
 
 class KWAV(Object):
     def __init__(self, stream, check=True):
         if check:
-            assert stream.read(4) == b'KWAV'
+            id, length = read_struct(stream, KWAV_HEADER)
+            assert id == b'KWAV'
+        else:
+            length = read_u32(stream)
 
-        length = struct.unpack("<L", stream.read(4))[0]
-        self.data = stream.read(length)
+        self.data = read_view(stream, length)
 
-    def export(self, directory, filename=None):
+    def export(self, directory, filename=None, **kwargs):
         if not filename:
             filename = "{}-{}".format("KWAV", str(uuid.uuid4()))
 
-        filename = os.path.join(directory, "{}.wav".format(filename))
-        command = ['ffmpeg', '-y', '-f', 's16le', '-ar', '11.025k', '-ac', '1', '-i', 'pipe:', filename]
-        with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) as p:
-            p.stdin.write(self.data)
-
-        logging.debug("KWAV.export: Wrote output on {}".format(filename))
+        export_wav(self.data, os.path.join(directory, "{}.wav".format(filename)))
 
 class SNCM(Object): # What does this mean?
     def __init__(self, stream):
-        assert stream.read(4) == b'SNCM'
-        assert stream.read(4) == b'\x00' * 4
+        id, zero, line_count = read_struct(stream, SNCM_HEADER)
+        assert id == b'SNCM'
+        assert zero == 0
 
-        line_count = struct.unpack("<L", stream.read(4))[0]
-        logging.debug("SNCM: Expecting {} lines".format(line_count))
+        logging.debug("SNCM: Expecting %d lines", line_count)
 
         # Do we know how mnay azeros there are?
-        while stream.read(1) == b'\x00':
-            continue
-
-        stream.seek(stream.tell() - 1)
+        padding = NONZERO.search(stream.buffer, stream.pos)
+        stream.pos = padding.start() if padding else stream.size()
 
         self.lines = []
         for i  in range(line_count):
-            size = struct.unpack("<L", stream.read(4))[0]
+            size = read_u32(stream)
             if i == 0:
                 self.size = size
 
-            run = stream.read(size)
+            run = read_view(stream, size)
 
             self.lines.append(run)
 
     def export(self, directory, filename, **kwargs):
         with open("{}.txt".format(os.path.join(directory, filename)), 'w') as of:
-            for line in self.lines:
-                of.write(str(list(line)))
+            # Same text as str(list(line)), without building an int list per line.
+            of.write("".join("[{}]".format(", ".join(map(BYTE_NAMES.__getitem__, line))) for line in self.lines))
             # of.write(b''.join(self.lines))
 
 class ANG(Object):
     def __init__(self, stream):
-        start = stream.tell()
+        start = stream.pos
 
-        assert stream.read(4) == b'ANG\x00'
-        assert stream.read(4) == b'\x00' * 4
-        
-        unk1 = struct.unpack("<L", stream.read(4))[0] # 01 00 00 00
-        logging.debug("ANG: Unk1: {}".format(unk1))
+        id, zero, unk1, frame_count, zero2, unk2 = read_struct(stream, ANG_HEADER)
+        assert id == b'ANG\x00'
+        assert zero == 0
+
+        logging.debug("ANG: Unk1: %d", unk1) # 01 00 00 00
         assert unk1 == 1
 
-        frame_count = struct.unpack("<L", stream.read(4))[0]
-        logging.debug("ANG: Expecting {} frames".format(frame_count))
+        logging.debug("ANG: Expecting %d frames", frame_count)
 
-        assert stream.read(4) == b'\x00' * 4
-        unk2 = struct.unpack("<L", stream.read(4))[0] # 00 00 00 01
-        logging.debug("ANG: Unk2: {}".format(unk1))
+        assert zero2 == 0
+        logging.debug("ANG: Unk2: %d", unk2) # 00 00 00 01
 
-        offsets = []
-        for _ in range(frame_count + 1):
-            offset = struct.unpack("<L", stream.read(4))[0]
-            logging.debug("ANG: Registered frame offset 0x{:04x}".format(offset))
-            offsets.append(offset)
+        offsets = read_array(stream, "<u4", frame_count + 1).tolist()
+        logging.debug("ANG: Registered %d frame offsets", len(offsets))
 
-        stream.seek(offsets[0] + start) # TODO: Determine the lengths of this field
+        stream.pos = offsets[0] + start # TODO: Determine the lengths of this field
 
-        self.meta_frames = []
-        for _ in range(frame_count):
-            header = stream.read(2)
-            while header != b'\x02\x7f':
-                header = stream.read(2)
+        self.meta_frames = read_meta_frames(stream, frame_count)
+        if self.meta_frames is not None:
+            logging.debug("ANG: Registered %d frame headers", frame_count)
+        else:
+            meta_frames = []
+            for _ in range(frame_count):
+                seek_past(stream, b'\x02\x7f')
+
+                meta_frame = read_struct(stream, ANG_META_FRAME)
 
-            meta_frame = {
-                "x": struct.unpack("<H", stream.read(2))[0],
-                "y": struct.unpack("<H", stream.read(2))[0],
-                "n": struct.unpack("<H", stream.read(2))[0]
-            }
+                meta_frames.append(meta_frame)
+                if VERIFY and stream.view[stream.pos:stream.pos + 2] != ZERO2:
+                    raise ValueError("ANG: Nonzero frame header padding at 0x{:012x}".format(stream.pos))
+                stream.pos += 2
 
-            self.meta_frames.append(meta_frame)
-            assert stream.read(2) == b'\x00\x00'
+                footer = stream.read(2)
+                if footer == b'\x02\x7f':
+                    stream.pos -= 2
+                else:
+                    assert footer == b'\x01\x7f'
 
-            footer = stream.read(2)
-            if footer == b'\x02\x7f':
-                stream.seek(stream.tell() - 2)
-            else:
-                assert footer == b'\x01\x7f'
+                logging.debug("ANG: Registered frame header: %s", meta_frame)
 
-            logging.debug("ANG: Registered frame header: {}".format(meta_frame))
+            self.meta_frames = np.array(meta_frames, dtype=META_FRAME)
 
         # HACK: I don't actually know what the unk2 signifies, but it means a
         # strante frame structure here.
-        footer = stream.read(2)
-        while footer != b'\x00\x7f':
-            footer = stream.read(2)
+        seek_past(stream, b'\x00\x7f')
 
         self.frames = []
-        for frame in self.meta_frames:
-            logging.debug("**** Reading frame {:03d} ****".format(frame["n"]))
-            self.frames.append({"frame": ANGFrame(stream)})
+        for n in self.meta_frames["n"].tolist():
+            logging.debug("**** Reading frame %03d ****", n)
+            self.frames.append(ANGFrame(stream))
             logging.debug("***************************")
 
     def export(self, directory, filename, **kwargs):
         if filename:
             directory = os.path.join(directory, filename)
 
-        Path(directory).mkdir(parents=True, exist_ok=True)
+        os.makedirs(directory, exist_ok=True)
 
         for i, frame in enumerate(self.frames):
-            frame["frame"].export(directory, str(i))
+            frame.export(directory, str(i), **kwargs)
 
-        with open(os.path.join(directory, "anim.json"), 'w') as header:
-            json.dump(self.meta_frames, fp=header)
+        names = META_FRAME.names
+        export_json([dict(zip(names, row)) for row in self.meta_frames.tolist()], os.path.join(directory, "anim.json"))
 
 class ANGFrame(Object):
     def __init__(self, stream, check=True):
         if check:
             value_assert(stream, b'P800')
 
-        self.width = struct.unpack("<H", stream.read(2))[0]
-        logging.debug("ANGFrame: Width: 0x{:04x}".format(self.width))
-
-        self.line_count = struct.unpack("<H", stream.read(2))[0]
-        logging.debug("ANGFrame: Expecting {} lines".format(self.line_count))
-
-        compressed = struct.unpack("<L", stream.read(4))[0]
-        logging.debug("ANGFrame: Compression: 0x{:04x}".format(compressed))
+        self.width, self.line_count, compressed = read_struct(stream, ANG_FRAME_HEADER)
+        logging.debug("ANGFrame: Width: 0x%04x", self.width)
+        logging.debug("ANGFrame: Expecting %d lines", self.line_count)
+        logging.debug("ANGFrame: Compression: 0x%04x", compressed)
 
-        self.lines = []
+        self.bitmap = None
         if self.width == 0:
             return
         
         if compressed == 0x0201: # Crazy RLE format
-            pos = stream.tell()
-            end = struct.unpack("<L", stream.read(4))[0] + pos # byte count to end STARTS here, and also starts here for all succeeding offsets
-
-            self.offsets = []
-            for _ in range(self.line_count):
-                offset = struct.unpack("<L", stream.read(4))[0]
-                logging.debug("ANGFrame: Registered offset 0x{:04x} (true: 0x{:04x})".format(offset, offset + pos))
-                self.offsets.append(offset + pos)
+            pos = stream.pos
+            end = read_u32(stream) + pos # byte count to end STARTS here, and also starts here for all succeeding offsets
 
-            self.offsets.append(end)
+            self.offsets = np.empty(self.line_count + 1, dtype=np.int64)
+            self.offsets[:-1] = read_array(stream, "<u4", self.line_count)
+            self.offsets[:-1] += pos
+            self.offsets[-1] = end
+            logging.debug("ANGFrame: Registered %d line offsets", self.line_count)
 
             # find ~/tmp/rr2 -name "*.dat"  -exec ./df.py '{}' \;
-            value_assert(stream.tell(), self.offsets[0])
-            prev = self.offsets[0]
-
-            for i, offset in enumerate(self.offsets[1:]):
-                end = offset
-                length = offset - stream.tell()
-                logging.debug("ANGFrame: ({}) Reading line 0x{:04x} (0x{:04x}) -> 0x{:04x} (0x{:04x} bytes)".format(i+1, stream.tell(), prev, offset, length))
-                line = []
-                while stream.tell() < end:
-                    op = int.from_bytes(stream.read(1), byteorder="little")
-                    if op >> 7: # RLE byte next
-                        color = stream.read(1)
-                        run = color * (op & 0b01111111)
-                    else: # unencoded data
-                        run = stream.read(op)
-
-                    line.append(run)
-
-                line = b''.join(line)
-                line += b'\x00' * max(0, self.width - len(line))
-                assert len(line) == self.width
-                self.lines.append(line)
+            value_assert(stream.pos, int(self.offsets[0]))
+
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                for i in range(self.line_count):
+                    logging.debug("ANGFrame: (%d) Line 0x%04x -> 0x%04x (0x%04x bytes)", i+1, self.offsets[i], self.offsets[i+1], self.offsets[i+1] - self.offsets[i])
+
+            if int(self.offsets.max()) > stream.size():
+                raise ValueError("ANGFrame: Line offsets run past the end of the file")
+
+            self.bitmap = np.empty((self.line_count, self.width), dtype=np.uint8)
+            line, length, pos = decode_rle_frame(np.frombuffer(stream.buffer, dtype=np.uint8), self.offsets, self.bitmap)
+            if length < 0:
+                raise ValueError("ANGFrame: Line {} runs past the end of the file".format(line))
+            if line != -1:
+                # Rows from here on were never written, so the bitmap can't be kept.
+                raise ValueError("ANGFrame: Line {} overflows width 0x{:04x}".format(line, self.width))
+            stream.pos = pos
         elif compressed == 0x0001: # uncompressed bitmap
-            for i in range(self.line_count):
-                self.lines.append(stream.read(self.width))
+            self.bitmap = read_array(stream, np.uint8, self.line_count * self.width).reshape(self.line_count, self.width)
         else:
             raise ValueError("Unknown compression type: 0x{:04x}".format(compressed))
 
-    def export(self, directory, filename, fmt="png"):
+    def export(self, directory, filename, fmt="png", palette=None, **kwargs):
         if self.width == 0 or self.line_count == 0:
             return
-        
-        output = PILImage.frombytes("P", (self.width, self.line_count), b''.join(self.lines))
-        output.save(encode_filename(os.path.join(directory, filename), fmt), fmt)
 
-def process(filename):
-    logging.debug("Processing file: {}".format(filename))
-    if args.export:
-        Path(args.export).mkdir(parents=True, exist_ok=True)
+        if fmt == "pgm":
+            export_pgm(self.bitmap, encode_filename(directory + os.sep + filename, fmt))
+            return
 
-    with open(filename, mode='rb') as f:
-        stream = mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ)
-        assert stream.read(4) == b'\x44\x46\x00\x00'
+        output = PILImage.frombuffer("P", (self.width, self.line_count), self.bitmap, "raw", "P", 0, 1)
+        if palette:
+            output.putpalette(palette)
+        # zlib dominates the PNG path; level 1 is several times faster than
+        # the default for a few percent larger files.
+        output.save(encode_filename(directory + os.sep + filename, fmt), fmt, compress_level=1)
 
-        chunks = []
-        # stream.seek(0xea6c)
-        # stream.seek(0x5dcc)
-        # stream.seek(0x1d5cc39)
-        # stream.seek(0x5e96e8)
-        stream.seek(0x010882)
-        chunk_ids = {}
-        file_map = []
-        try:
-            while stream.tell() < stream.size():
-                start = stream.tell()
-                chunk = CDChunk(stream)
+def read_xxxx(stream, length):
+    if length == 0x0300:
+        return Palette(stream, length)
 
-                if not chunk_ids.get(chunk.id):
-                    chunk_ids.update({chunk.id: 0})
+    return Container(stream)
 
-                chunk_ids[chunk.id] += 1
-                logging.info(
-                    "process: (0x{:012x} \\ 0x{:012x}) [{:2.2f}%] Chunk: {} (0x{:08x} bytes)".format(
-                        start, stream.size(), start/stream.size() * 100, chunk.id, chunk.length)
-                )
+CHUNK_HANDLERS = {
+    fourcc(b'KWAV'): lambda stream, length: KWAV(stream),
+    fourcc(b'ANG\x00'): lambda stream, length: ANG(stream),
+    fourcc(b'FNT0'): FNT0,
+    fourcc(b'CHR\x00'): CHR,
+    fourcc(b'P800'): lambda stream, length: ANGFrame(stream),
+    fourcc(b'SNCM'): lambda stream, length: SNCM(stream),
+    fourcc(b'XXXX'): read_xxxx,
+}
 
-                file_map.append({
-                    "id": chunk.id,
-                    "start": "0x{:012x}".format(start),
-                    "length": chunk.length,
-                    "chunk": True if chunk.chunk else False
-                })
+# Chunks that hold decoded bitmaps by the time they are exported.
+DECODED_CHUNKS = (CHR, ANG, ANGFrame)
 
-                if args.export:
-                    chunk.export(args.export, "{}-{}".format(chunk.id, chunk_ids[chunk.id]))
+def process(filename):
+    logging.debug("Processing file: %s", filename)
+    if args.export:
+        Path(args.export).mkdir(parents=True, exist_ok=True)
 
-                    with open(os.path.join(args.export, "df.json"), 'w') as fmap:
-                        json.dump(file_map, fp=fmap)
+    with open(filename, mode='rb') as f:
+        mapped = mmap.mmap(f.fileno(), length=0, access=mmap.ACCESS_READ)
+        if hasattr(mmap, "MADV_SEQUENTIAL"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        stream = Cursor(mapped)
+        value_assert(stream, b'\x44\x46\x00\x00')
 
-        except Exception as e:
-            logging.error("Exception at {}:{:012x}".format(filename, stream.tell()))
-            raise
+        chunks = []
+        # stream.pos = 0xea6c
+        # stream.pos = 0x5dcc
+        # stream.pos = 0x1d5cc39
+        # stream.pos = 0x5e96e8
+        stream.pos = 0x010882
+        chunk_ids = defaultdict(int)
+        palette = None
+        file_map = []
+        total = stream.size()
+        export = args.export
+        fmt = args.fmt
+        with ExportPool() as pool:
+            try:
+                offsets, lengths = scan_chunks(np.frombuffer(mapped, dtype=np.uint8), stream.pos)
+                for start, length in zip(offsets.tolist(), lengths.tolist()):
+                    stream.pos = start
+                    chunk = CDChunk(stream, skip=not export)
+                    value_assert(stream.pos, start + 16 + length, "chunk end", warn=True)
+
+                    chunk_ids[chunk.id] += 1
+                    logging.info(
+                        "process: (0x%012x \\ 0x%012x) [%2.2f%%] Chunk: %s (0x%08x bytes)",
+                        start, total, start/total * 100, chunk.id, chunk.length
+                    )
+
+                    file_map.append({
+                        "id": chunk.id,
+                        "start": "0x{:012x}".format(start),
+                        "length": chunk.length,
+                        "chunk": True if chunk.chunk else False
+                    })
+
+                    if isinstance(chunk.chunk, Palette):
+                        palette = bytes(chunk.chunk.data)
+
+                    if export:
+                        name = "{}-{}".format(chunk.id, chunk_ids[chunk.id])
+                        submit = pool.submit if isinstance(chunk.chunk, DECODED_CHUNKS) else pool.submit_batched
+                        submit((name, start), chunk.export, export, name, fmt=fmt, palette=palette)
+
+            except ExportError:
+                # Raised from an earlier chunk's export job; the parser position
+                # has nothing to do with it.
+                raise
+
+            except Exception as e:
+                logging.error("Exception at %s:%012x", filename, stream.pos)
+                raise
+
+            finally:
+                if export:
+                    export_json(file_map, os.path.join(export, "df.json"))
 
 def main():
+    global VERIFY
+    VERIFY = args.verify
     process(args.input)
 
 if __name__ == "__main__":
@@ -457,6 +782,16 @@ if __name__ == "__main__":
         help="Specify the location for exporting assets, or omit to skip export."
     )
 
+    parser.add_argument(
+        "--fmt", choices=("png", "pgm"), default="png",
+        help="Image format for exported frames; pgm writes raw palette indices."
+    )
+
+    parser.add_argument(
+        "--verify", action="store_true",
+        help="Check padding fields while parsing instead of skipping over them."
+    )
+
     args = parser.parse_args()
     logging.basicConfig(level=logging.INFO)
     main()